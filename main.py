@@ -1,82 +1,384 @@
+import atexit
+import functools
 import uuid
+from collections import OrderedDict, deque
+from itertools import chain, islice
 from datetime import datetime
 from flask import Flask, request, jsonify
-import json
+from flask.json.provider import JSONProvider
+import mmap
 import os
 import sys
+import threading
+import time
+
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    import json
+
+    def json_dumps(obj):
+        """Compact stdlib fallback returning bytes like orjson.dumps."""
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+
+    def json_loads(data):
+        """Stdlib fallback accepting any bytes-like object like orjson.loads."""
+        return json.loads(data if isinstance(data, (str, bytes)) else bytes(data))
+
+
+class FastJSONProvider(JSONProvider):
+    """JSON provider that serializes Flask responses with orjson when available."""
+
+    def dumps(self, obj, **kwargs):
+        return json_dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return json_loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(json_dumps(obj), mimetype='application/json')
+
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
+# Larger bodies get 413. A body with a bigger Content-Length is rejected before
+# it is read; a chunked body is read up to the limit and rejected by
+# request_json() if it goes on. This bounds memory only because the server
+# streams bodies to Flask (a2wsgi, gunicorn gthread).
+app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
 
 # Constants
 MAX_HISTORY_SIZE = 9
 DATA_FILE = 'commands_data.json'
+FLUSH_INTERVAL = int(os.environ.get('FLUSH_INTERVAL_MS', '100')) / 1000  # seconds to coalesce changes
+FLUSH_MAX_PENDING = int(os.environ.get('FLUSH_MAX_PENDING', '1000'))  # changes that force an early write
+FLUSH_RETRY_MAX = 30  # seconds between retries once writes keep failing
+DURABLE_WRITES = os.environ.get('DURABLE_WRITES') == '1'  # O_DSYNC + directory fsync
+SOURCES = frozenset({'new_commands', 'history'})
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', '32'))  # threads running Flask under uvicorn
+MAX_POLL_WAIT = 30  # seconds /get_command may hold a request open
+# Long polls allowed at once; keep well below the server's thread count so
+# waiting consumers cannot starve the add_command that would wake them
+MAX_LONG_POLLS = int(os.environ.get('MAX_LONG_POLLS', str(max(SERVER_THREADS // 4, 1))))
+STREAM_CHUNK_SIZE = 64 * 1024  # bytes per chunk of a streamed JSON response
+RESPONSE_CACHE_SIZE = 128  # cached GET response bodies
+ID_BATCH_SIZE = 256  # command ids generated per os.urandom() call
+TIMESTAMP_REUSE_NS = 1_000_000  # reuse a formatted timestamp for up to 1 ms
 
-def load_commands():
-    """Load commands from JSON file."""
+# In-memory copy of the commands file, loaded on first use.
+# new_commands is kept as an OrderedDict keyed by command id and history
+# as a deque bounded by MAX_HISTORY_SIZE.
+_STATE = None
+# Encoded JSON of each pending command, reused by list responses until the
+# command is moved to history or handed out
+_ENCODED = {}
+_LOCK = threading.RLock()
+_WRITE_LOCK = threading.Lock()  # keeps file writes in order
+_DIRTY = threading.Event()
+_FLUSH_EARLY = threading.Event()
+_PENDING_CHANGES = 0  # changes since the last flush
+_FLUSH_FAILURES = 0  # failed writes in a row
+_COMMAND_ADDED = threading.Condition(_LOCK)
+_LONG_POLLS = threading.BoundedSemaphore(MAX_LONG_POLLS)
+_LAST_HASH = None  # hash of the bytes last written to DATA_FILE
+_COMMAND_IDS = deque()  # pre-generated command ids
+_LAST_TIMESTAMP = (0, '')  # (time_ns, ISO string) of the last formatted timestamp
+_VERSION = 0  # bumped on every change to the commands
+_RESPONSE_CACHE = OrderedDict()  # (path, query, version) -> response body
+
+def _read_file():
+    """Read commands from JSON file, parsing it straight from a memory map."""
     try:
-        with open(DATA_FILE, 'r') as f:
-            data = json.load(f)
+        with open(DATA_FILE, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                memoryview(mm) as view:
+            data = json_loads(view)
             return data
-    except (FileNotFoundError, json.JSONDecodeError) as e:
+    # ValueError also covers empty files, which cannot be mapped
+    except (FileNotFoundError, ValueError) as e:
         return {'new_commands': [], 'history': []}
 
+def _index_commands(data):
+    """Convert data read from JSON file into the in-memory layout."""
+    data['new_commands'] = OrderedDict((cmd['id'], cmd) for cmd in data['new_commands'])
+    for command in data['new_commands'].values():
+        _ENCODED[command['id']] = json_dumps(command)
+    data['history'] = deque(data['history'], maxlen=MAX_HISTORY_SIZE)
+    return data
+
+def _serialize_commands(data):
+    """Convert the in-memory layout back into the JSON file layout."""
+    return {'new_commands': list(data['new_commands'].values()), 'history': list(data['history'])}
+
+def load_commands():
+    """Return the in-memory commands, reading the JSON file only once."""
+    global _STATE
+    with _LOCK:
+        if _STATE is None:
+            _STATE = _index_commands(_read_file())
+        return _STATE
+
 def save_commands(data):
-    """Save commands to JSON file."""
+    """Update the in-memory commands and schedule a write to JSON file."""
+    global _STATE, _PENDING_CHANGES, _VERSION
+    with _LOCK:
+        _STATE = data
+        _VERSION += 1
+        _RESPONSE_CACHE.clear()
+        _PENDING_CHANGES += 1
+        _DIRTY.set()
+        if _PENDING_CHANGES >= FLUSH_MAX_PENDING:
+            _FLUSH_EARLY.set()
+
+def flush_now():
+    """Write pending changes to JSON file immediately.
+
+    Only the snapshot is taken under _LOCK; encoding and disk IO happen
+    outside it so request handlers are not blocked by the write.
+    """
+    global _PENDING_CHANGES, _FLUSH_FAILURES
+    with _WRITE_LOCK:
+        with _LOCK:
+            if not _DIRTY.is_set():
+                return
+            _DIRTY.clear()
+            _FLUSH_EARLY.clear()
+            _PENDING_CHANGES = 0
+            snapshot = _serialize_commands(_STATE)
+        try:
+            _write_file(snapshot)
+        except Exception as e:
+            # Report only the first error of a streak of failed writes
+            if not _FLUSH_FAILURES:
+                print(f"DEBUG: Error saving data: {e}", file=sys.stderr)
+            _FLUSH_FAILURES += 1
+            # Keep the changes pending so the flusher (or atexit) retries them
+            _DIRTY.set()
+        else:
+            if _FLUSH_FAILURES:
+                print(f"DEBUG: Data saved after {_FLUSH_FAILURES} failed attempts", file=sys.stderr)
+            _FLUSH_FAILURES = 0
+
+def _flush_loop():
+    """Background writer that batches changes made within FLUSH_INTERVAL.
+
+    A batch is written early once FLUSH_MAX_PENDING changes have piled up.
+    After a failed write the next attempt waits twice as long as the last
+    one, up to FLUSH_RETRY_MAX.
+    """
+    while True:
+        _DIRTY.wait()
+        _FLUSH_EARLY.wait(FLUSH_INTERVAL)
+        flush_now()
+        if _FLUSH_FAILURES:
+            time.sleep(min(FLUSH_INTERVAL * 2 ** min(_FLUSH_FAILURES, 16), FLUSH_RETRY_MAX))
+
+def _write_file(data):
+    """Save commands to JSON file with a single write and an atomic rename.
+
+    The write is skipped when the encoded data matches what was last written.
+    A crash mid-write can only leave a stale temp file, never a torn DATA_FILE.
+    On error the temp file is removed and the exception re-raised.
+    """
+    global _LAST_HASH
+    tmp_path = DATA_FILE + '.tmp'
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    if DURABLE_WRITES:
+        flags |= getattr(os, 'O_DSYNC', 0)
     try:
-        with open(DATA_FILE, 'w') as f:
-            json.dump(data, f, indent=2)
-    except Exception as e:
-        print(f"DEBUG: Error saving data: {e}", file=sys.stderr)
+        buf = json_dumps(data)
+        buf_hash = hash(buf)
+        if buf_hash == _LAST_HASH:
+            return
+        fd = os.open(tmp_path, flags, 0o644)
+        try:
+            view = memoryview(buf)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, DATA_FILE)
+        if DURABLE_WRITES:
+            _fsync_dir(os.path.dirname(os.path.abspath(DATA_FILE)))
+        _LAST_HASH = buf_hash
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _fsync_dir(path):
+    """Flush a directory entry so a completed rename survives a crash."""
+    if os.name != 'posix':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _flush_at_exit():
+    """Retry pending changes once more on shutdown and report if they are lost."""
+    flush_now()
+    if _DIRTY.is_set():
+        print("DEBUG: Unsaved changes lost on exit", file=sys.stderr)
+
+threading.Thread(target=_flush_loop, name='commands-flusher', daemon=True).start()
+atexit.register(_flush_at_exit)
+
+def json_list_response(items, key=None):
+    """Encode a list of commands as a JSON array, optionally wrapped as {key: [...]}.
+
+    Items are encoded one at a time (or taken from _ENCODED) in chunks of about
+    STREAM_CHUNK_SIZE bytes. A body that fits in one chunk is returned as is;
+    larger ones are streamed so the full body is never built.
+    """
+    def generate():
+        chunk = bytearray(b'{' + json_dumps(key) + b':[' if key else b'[')
+        for i, item in enumerate(items):
+            if i:
+                chunk += b','
+            chunk += _ENCODED.get(item['id']) or json_dumps(item)
+            if len(chunk) >= STREAM_CHUNK_SIZE:
+                yield bytes(chunk)
+                chunk.clear()
+        chunk += b']}' if key else b']'
+        yield bytes(chunk)
+    
+    chunks = generate()
+    first = next(chunks)
+    second = next(chunks, None)
+    if second is None:
+        return app.response_class(first, mimetype='application/json')
+    return app.response_class(chain((first, second), chunks), mimetype='application/json')
+
+def cache_until_changed(view):
+    """Reuse a GET view's JSON body until the commands change.
+
+    Bodies are keyed by path, query string and _VERSION; streamed (large)
+    and non-200 responses are not cached.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        cache_key = (request.path, request.query_string, _VERSION)
+        body = _RESPONSE_CACHE.get(cache_key)
+        if body is not None:
+            return app.response_class(body, mimetype='application/json')
+        
+        response = app.make_response(view(*args, **kwargs))
+        if response.status_code == 200 and not response.is_streamed:
+            with _LOCK:
+                _RESPONSE_CACHE[cache_key] = response.get_data()
+                while len(_RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+                    _RESPONSE_CACHE.popitem(last=False)
+        return response
+    return wrapper
+
+def new_command_id():
+    """Return a random uuid4 string, drawing entropy for ID_BATCH_SIZE ids at once."""
+    try:
+        return _COMMAND_IDS.popleft()
+    except IndexError:
+        entropy = os.urandom(16 * ID_BATCH_SIZE)
+        ids = [str(uuid.UUID(bytes=entropy[i:i + 16], version=4)) for i in range(0, len(entropy), 16)]
+        _COMMAND_IDS.extend(ids[1:])
+        return ids[0]
+
+def now_iso():
+    """Return datetime.now().isoformat(), reusing the last value within TIMESTAMP_REUSE_NS."""
+    global _LAST_TIMESTAMP
+    now_ns = time.time_ns()
+    last_ns, last_iso = _LAST_TIMESTAMP
+    if 0 <= now_ns - last_ns < TIMESTAMP_REUSE_NS:
+        return last_iso
+    iso = datetime.fromtimestamp(now_ns / 1e9).isoformat()
+    _LAST_TIMESTAMP = (now_ns, iso)
+    return iso
+
+def request_json():
+    """Parse the request body without caching it, or return None if it is not JSON."""
+    data = request.get_data(cache=False)
+    if len(data) >= app.config['MAX_CONTENT_LENGTH']:
+        # A chunked body is cut off at the limit without an error; reading
+        # past it raises RequestEntityTooLarge (413) if anything is left
+        request.stream.read(1)
+    try:
+        return json_loads(data)
+    except ValueError:
+        return None
+
+def _take_first(commands, count):
+    """Return the first count items without copying the rest."""
+    if count >= 0:
+        return list(islice(commands, count))
+    return list(commands)[:count]
+
+def _take_last(commands, count):
+    """Return the last count items of a reversible collection without copying the rest."""
+    if count > 0:
+        return list(islice(reversed(commands), count))[::-1]
+    return list(commands)[-count:]
 
 def read_first_commands(count='1'):
     """Read first few commands from the database."""
-    data = load_commands()
-    
-    if count == 'all':
-        return data['new_commands']
-    else:
-        try:
-            count = int(count)
-            return data['new_commands'][:count]
-        except ValueError:
-            raise ValueError('Invalid count parameter')
+    with _LOCK:
+        data = load_commands()
+        
+        if count == 'all':
+            return list(data['new_commands'].values())
+        else:
+            try:
+                count = int(count)
+                return _take_first(data['new_commands'].values(), count)
+            except ValueError:
+                raise ValueError('Invalid count parameter')
 
 def select_last_commands(count='all'):
     """Select last few commands from the database."""
-    data = load_commands()
-    
-    if count == 'all':
-        return data['new_commands']
-    else:
-        try:
-            count = int(count)
-            result = data['new_commands'][-count:] if count <= len(data['new_commands']) else data['new_commands']
-            return result
-        except ValueError:
-            raise ValueError('Invalid count parameter')
+    with _LOCK:
+        data = load_commands()
+        
+        if count == 'all':
+            return list(data['new_commands'].values())
+        else:
+            try:
+                count = int(count)
+                return _take_last(data['new_commands'].values(), count)
+            except ValueError:
+                raise ValueError('Invalid count parameter')
 
 def move_commands_to_history(command_ids):
     """Move specified commands to history."""
-    data = load_commands()
+    # Reject bad ids before any command is removed from the queue
+    if not isinstance(command_ids, list) or not all(isinstance(command_id, str) for command_id in command_ids):
+        raise ValueError('ids must be a list of strings')
     
-    for command_id in command_ids:
-        for command in data['new_commands']:
-            if command['id'] == command_id:
-                command['time_started'] = datetime.now().isoformat()
-                data['history'].append(command)
-                data['new_commands'].remove(command)
-                break
+    started = now_iso()
     
-    # Manage history size
-    if len(data['history']) > MAX_HISTORY_SIZE:
-        data['history'] = data['history'][-MAX_HISTORY_SIZE:]
-    
-    save_commands(data)
+    with _LOCK:
+        data = load_commands()
+        new_commands = data['new_commands']
+        # Collect the commands first so nothing is removed unless all of them move
+        moved_ids = [command_id for command_id in dict.fromkeys(command_ids) if command_id in new_commands]
+        if not moved_ids:
+            return
+        
+        moved = []
+        for command_id in moved_ids:
+            command = new_commands.pop(command_id)
+            _ENCODED.pop(command_id, None)
+            command['time_started'] = started
+            moved.append(command)
+        # The history deque drops the oldest entries past MAX_HISTORY_SIZE
+        data['history'].extend(moved)
+        
+        save_commands(data)
 
 @app.route('/add_command', methods=['POST'])
 def add_command():
-    data = load_commands()
-    command_data = request.json
+    command_data = request_json()
     
     # Валидация формата запроса
     if not isinstance(command_data, dict):
@@ -88,23 +390,25 @@ def add_command():
     if not scenario or not isinstance(actions, list):
         return jsonify({'error': 'Сценарий и действия обязательны'}), 400
     
-    # Обработка действий
-    for action in actions:
-        action_name = action.get('name')
-        action_func = action.get('func')
-        # Реализуйте логику обработки действий здесь
+    # Каждое действие должно быть объектом
+    if not all(isinstance(action, dict) for action in actions):
+        return jsonify({'error': 'Действия должны быть объектами'}), 400
     
-    command_id = str(uuid.uuid4())
+    command_id = new_command_id()
     
     new_command = {
         'id': command_id,
         'scenario': scenario,
         'actions': actions,
-        'time_created': datetime.now().isoformat()
+        'time_created': now_iso()
     }
     
-    data['new_commands'].append(new_command)
-    save_commands(data)
+    _ENCODED[command_id] = json_dumps(new_command)
+    with _LOCK:
+        data = load_commands()
+        data['new_commands'][command_id] = new_command
+        save_commands(data)
+        _COMMAND_ADDED.notify()
     
     return jsonify({
         'status': 'success', 
@@ -113,49 +417,53 @@ def add_command():
     })
 
 @app.route('/read_first', methods=['GET'])
+@cache_until_changed
 def read_first():
-    data = load_commands()
-    
     # Параметры запроса
     count = request.args.get('count', '1')
     source = request.args.get('source', 'new_commands')
     command_type = request.args.get('type')
     
     # Выбор источника команд
-    if source not in ['new_commands', 'history']:
+    if source not in SOURCES:
         return jsonify({'error': 'Invalid source. Use "new_commands" or "history"'}), 400
     
-    commands = data.get(source, [])
-    
-    # Фильтрация по типу команды
-    if command_type:
-        commands = [cmd for cmd in commands if cmd.get('command') == command_type]
-    
     # Обработка количества команд
     try:
-        if count.lower() == 'all':
-            result = commands
-        else:
-            count = int(count)
-            result = commands[:count]
+        count = None if count.lower() == 'all' else int(count)
     except ValueError:
         return jsonify({'error': 'Count must be a number or "all"'}), 400
     
-    return jsonify(result)
+    with _LOCK:
+        commands = load_commands().get(source, [])
+        if source == 'new_commands':
+            commands = commands.values()
+        
+        # Фильтрация по типу команды
+        if command_type:
+            commands = (cmd for cmd in commands if cmd.get('command') == command_type)
+        
+        result = list(commands) if count is None else _take_first(commands, count)
+    
+    return json_list_response(result)
 
 @app.route('/select_last', methods=['GET'])
+@cache_until_changed
 def select_last():
     count = request.args.get('count', 'all')
     
     try:
         commands = select_last_commands(count)
-        return jsonify(commands)
+        return json_list_response(commands)
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
 
 @app.route('/move_to_history', methods=['POST'])
 def move_to_history():
-    command_ids = request.json.get('ids', [])
+    payload = request_json()
+    if not isinstance(payload, dict):
+        return jsonify({'error': 'Некорректный формат запроса'}), 400
+    command_ids = payload.get('ids', [])
     
     try:
         move_commands_to_history(command_ids)
@@ -165,21 +473,51 @@ def move_to_history():
 
 @app.route('/get_command', methods=['GET'])
 def get_command():
-    data = load_commands()
-    if data['new_commands']:
-        # Получаем и удаляем первую команду
-        command = data['new_commands'].pop(0)
-        save_commands(data)
-        return jsonify(command), 200
-    return jsonify({}), 204
+    # Long polling: ?wait=N blocks up to N seconds until a command is added
+    try:
+        wait = min(float(request.args.get('wait', 0)), MAX_POLL_WAIT)
+    except ValueError:
+        return jsonify({'error': 'Wait must be a number of seconds'}), 400
+    
+    # When MAX_LONG_POLLS requests are already waiting, answer immediately
+    long_poll = wait > 0 and _LONG_POLLS.acquire(blocking=False)
+    try:
+        with _LOCK:
+            data = load_commands()
+            if long_poll:
+                _COMMAND_ADDED.wait_for(lambda: data['new_commands'], timeout=wait)
+            if data['new_commands']:
+                # Получаем и удаляем первую команду
+                command_id, command = data['new_commands'].popitem(last=False)
+                encoded = _ENCODED.pop(command_id, None) or json_dumps(command)
+                save_commands(data)
+                return app.response_class(encoded, mimetype='application/json'), 200
+    finally:
+        if long_poll:
+            _LONG_POLLS.release()
+    return '', 204
 
 @app.route('/get_latest_commands', methods=['GET'])
+@cache_until_changed
 def get_latest_commands():
-    try:
-        commands = select_last_commands(count='all')  # Получаем все команды
-        return jsonify({'new_commands': commands}), 200
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    with _LOCK:
+        commands = list(load_commands()['new_commands'].values())  # Получаем все команды
+    return json_list_response(commands, key='new_commands'), 200
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    import uvicorn
+    from a2wsgi import WSGIMiddleware
+    
+    def input_terminated(environ, start_response):
+        # a2wsgi's body stream ends with the request body, but without this
+        # key Werkzeug reads chunked bodies (no Content-Length) as empty
+        environ.setdefault('wsgi.input_terminated', True)
+        return app(environ, start_response)
+
+    # A single worker only: commands are kept in this process's memory.
+    # a2wsgi streams request bodies to Flask instead of buffering them.
+    uvicorn.run(
+        WSGIMiddleware(input_terminated, workers=SERVER_THREADS),
+        host=os.environ.get('HOST', '127.0.0.1'),
+        port=int(os.environ.get('PORT', '5000')),
+    )